@@ -1,13 +1,28 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import yt_dlp
 import os
+import re
 import logging
+import logging.handlers
+import atexit
 import sys
 import asyncio
-import random
-import string
-import requests
+import threading
+import time
+import itertools
+import sqlite3
+import aiohttp
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+
+# uvloop is optional; when it is installed the bot runs on its faster event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Code made by: spyflow
 # Discord: spyflow
@@ -19,71 +34,313 @@ intents.typing = False
 intents.presences = True
 intents.message_content = True
 inactive_time = 300
-bot = commands.Bot(command_prefix='!', intents=intents)
-queue = []  # Playlist
-sname = []  # List of song names
-current_song = None  # Currently playing song
-inactive_timer = None  # Inactivity timer
+
+
+class MusicBot(commands.Bot):
+    async def setup_hook(self):
+        global http_session
+        global download_semaphore
+
+        # One keep-alive session for all YouTube API requests, created before any command runs
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, limit_per_host=10, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=5),
+        )
+        # Python 3.8 and 3.9 bind a semaphore to a loop when it is created, so it waits for the loop bot.run starts
+        download_semaphore = asyncio.Semaphore(max_downloads)
+        # Bound the threads used by asyncio.to_thread for cache and database work
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=4, thread_name_prefix='io'))
+        # Load the disk cache before any command can queue a song
+        await initialize_cache_state()
+        self.save_task = self.loop.create_task(save_cache_index_loop())
+
+    async def close(self):
+        # Downloads still waiting for a slot are not needed any more; fetch_song only waits on the shared
+        # download through asyncio.shield, so the download tasks themselves have to be cancelled too
+        for download_task in [*download_tasks, *pending_downloads.values()]:
+            download_task.cancel()
+        # Stop the periodic save so it cannot run alongside the final one
+        save_task = getattr(self, 'save_task', None)
+        if save_task is not None:
+            save_task.cancel()
+        # Keep the latest cache index for the next start
+        await save_cache_index()
+        # Close the shared HTTP session before the bot shuts down
+        if http_session is not None and not http_session.closed:
+            await http_session.close()
+        await super().close()
+
+
+bot = MusicBot(command_prefix='!', intents=intents)
+
+
+# Player state of a single guild
+@dataclass
+class GuildState:
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)  # Playlist of QueuedSong
+    playback_done: asyncio.Event = field(default_factory=asyncio.Event)  # Set when the current song ends
+    player_task: asyncio.Task = None  # Task running player_loop
+    voice_channel: discord.VoiceClient = None  # Voice client the player plays through
+    current_song: object = None  # Currently playing song
+    song_name: str = None  # Name of the currently playing song
+    voice_lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # Held while joining the voice channel
+    download_wait: asyncio.Future = None  # Resolved by !skip while the player waits for a song's download
+    skip_requested: bool = False  # Set by !skip, so a skipped stream is not mistaken for a failed one
+    play_error: Exception = None  # Error the voice player reported when the last song ended, if any
+    added_songs: list = field(default_factory=list)  # Names of added songs not announced yet
+    announce_task: asyncio.Task = None  # Task sending the next "Added to queue" message
+
+
+# A song waiting in a guild's queue
+@dataclass
+class QueuedSong:
+    download_task: asyncio.Task  # fetch_song task resolving to the cached file path
+    song_name: str
+    codec: str  # 'opus' when FFmpeg only has to remux Opus audio, else None
+    stream_url: str  # Direct media URL to play while the download is still running, or None
+
+
+# A song kept in the disk cache
+@dataclass
+class CachedSong:
+    file_path: str
+    size: int  # Bytes on disk
+    last_used: float  # Time the song was last queued
+    hits: int = 1  # Times the song was queued
+
+
+states = defaultdict(GuildState)  # Guild id -> GuildState
+file_refs = {}  # Cached file path -> number of queued songs using it
+max_queue_size = 100  # Maximum number of queued songs per guild
+added_message_delay = 0.5  # Seconds songs added to a guild's queue are collected into one message
+stream_min_play_time = 5  # Seconds; a stream that ends sooner is treated as failed and the download is played instead
+max_downloads = 4  # Maximum number of simultaneous downloads
+download_semaphore = None  # Limits simultaneous downloads, created in setup_hook
+download_tasks = set()  # fetch_song tasks that have not finished yet
+# One thread per download slot, used only by downloads
+download_executor = ThreadPoolExecutor(max_workers=max_downloads, thread_name_prefix='yt-dlp')
+# Separate threads for searches and metadata, so a !play lookup never waits for a running download
+extract_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='yt-dlp-info')
+http_session = None  # Shared aiohttp session for YouTube API requests
+search_cache = OrderedDict()  # Normalized search prompt -> (video link or None, expiry time)
+search_cache_size = 4096  # Maximum number of cached searches
+search_cache_ttl = 86400  # Seconds a found video stays cached
+search_cache_miss_ttl = 300  # Seconds a search without results stays cached
+pending_searches = {}  # Normalized search prompt -> task requesting it from the API
+pending_downloads = {}  # Video id -> task downloading it into the cache
+search_db_path = 'search_cache.db'  # SQLite file keeping found videos, song titles and the cache index across restarts
+metadata_cache = OrderedDict()  # Link -> (yt-dlp metadata, expiry time)
+metadata_cache_size = 1024  # Maximum number of cached metadata extractions
+metadata_cache_ttl = 3600  # Seconds cached metadata stays valid, well before its stream URL expires
 ufo = "idle"
+last_presence = None  # Last activity name sent to Discord
+author_message = 'Author: <@!533093302031876096>'
+url_prefixes = ('http://', 'https://', 'www.', 'youtube.com/', 'youtu.be/')  # Inputs treated as links
+youtube_id_pattern = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/)([A-Za-z0-9_-]{11})')  # Video id in a YouTube link
+
+# Downloaded songs are kept in music_dir as a cache of up to max_cache_bytes
+music_dir = 'music'
+max_cache_bytes = 2 * 1024 ** 3
+cache_index = OrderedDict()  # Video id -> CachedSong, least recently used first
+eviction_samples = 16  # Least recently used songs compared when choosing the next one to evict
+cache_size = 0  # Total bytes of the songs in cache_index
+cache_save_interval = 30  # Seconds between saves of the cache index
+changed_songs = set()  # Video ids added or used since the index was last saved
+removed_songs = set()  # Video ids evicted since the index was last saved
 
 # Initialize the yt-dlp downloader
 ydl_opts = {
-    'format': 'bestaudio/best',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '192',
-    }],
-    'outtmpl': 'music/%(id)s',
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',  # Prefer Opus so it can be sent to Discord without re-encoding
+    'outtmpl': f'{music_dir}/%(id)s.%(ext)s',
+    'noplaylist': True,  # A watch link inside a playlist resolves to just its video
+    'concurrent_fragment_downloads': 8,  # Fetch fragmented (DASH/HLS) streams over parallel connections
+    'http_chunk_size': 1048576,  # Request the stream in 1 MiB chunks
+    'buffersize': 65536,  # Write downloaded data in 64 KiB blocks
+    # The DASH manifest repeats the audio formats the player response already lists, so skip fetching it;
+    # HLS is kept because live streams only offer it
+    'extractor_args': {'youtube': {'skip': ['dash']}},
 }
 
-ydl = yt_dlp.YoutubeDL(ydl_opts)
+# One yt-dlp downloader per worker thread, built once and reused across songs.
+# YoutubeDL keeps cookies and downloader state, so a single instance must not be shared between threads.
+ydl_local = threading.local()
+
+def get_ydl():
+    if not hasattr(ydl_local, 'ydl'):
+        ydl_local.ydl = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl_local.ydl
+
+# FFmpeg flags that skip input probing and buffering to cut the gap before a song starts
+ffmpeg_before_options = '-nostdin -fflags nobuffer -flags low_delay -probesize 32 -analyzeduration 0'
+# discord.py adds its own -loglevel warning after the input, so this later -loglevel error is the one FFmpeg uses
+ffmpeg_options = '-vn -loglevel error'
+# Streams read straight from YouTube also need to survive dropped connections
+ffmpeg_stream_before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 ' + ffmpeg_before_options
 
 # Configure the logger
 logger = logging.getLogger('discord')
 logger.setLevel(logging.INFO)
 handler = logging.StreamHandler()
-logger.addHandler(handler)
+# Log calls only enqueue the record; a background thread writes it to the stream
+log_queue = SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+# Searches that only differ in case or spacing share a cache entry
+def search_key(prompt):
+    return ' '.join(prompt.casefold().split())
+
+# Return (True, video link or None) for a remembered search, or (False, None)
+async def lookup_search(key):
+    # Return the cached result if the same search was made recently
+    cached = search_cache.get(key)
+    if cached is not None:
+        video_link, expires_at = cached
+        if time.monotonic() < expires_at:
+            search_cache.move_to_end(key)
+            return True, video_link
+        del search_cache[key]
+
+    # Fall back to searches saved by earlier runs of the bot
+    saved = await asyncio.to_thread(load_search, key)
+    if saved is not None:
+        video_link, age = saved
+        remember_search(key, video_link, search_cache_ttl - age)
+        return True, video_link
+
+    return False, None
+
+# Search for a song and resolve its metadata, in one yt-dlp call when possible
+async def find_song_info(prompt):
+    key = search_key(prompt)
+    found, video_link = await lookup_search(key)
+    if found:
+        return await get_song_info(video_link) if video_link else None
 
-
-# Search for a video on YouTube
-def searchinyt(prompt):
+    try:
+        info = await bot.loop.run_in_executor(extract_executor, extract_song_info, f'ytsearch1:{prompt}')
+        entries = info.get('entries') or []
+    except Exception as e:
+        logger.warning('yt-dlp search failed, using the YouTube API: %s', e)
+        entries = []
+
+    if entries:
+        info_dict = entries[0]
+        video_link = info_dict['webpage_url']
+        remember_search(key, video_link, search_cache_ttl)
+        await asyncio.to_thread(save_search, key, video_link)
+        remember_song_info(video_link, info_dict)
+        await asyncio.to_thread(save_song_info, video_link, info_dict)
+        return dict(info_dict)
+
+    # yt-dlp found nothing or was rate limited, fall back to the YouTube Data API
+    video_link = await request_search_once(key, prompt)
+    return await get_song_info(video_link) if video_link else None
+
+async def request_search_once(key, prompt):
+    # Identical searches made at the same time share a single API request
+    pending = pending_searches.get(key)
+    if pending is None:
+        pending = asyncio.create_task(request_search(key, prompt))
+        pending_searches[key] = pending
+        pending.add_done_callback(lambda task: pending_searches.pop(key, None))
+    return await asyncio.shield(pending)
+
+# Ask the YouTube API for the first video matching the prompt
+async def request_search(key, prompt):
     # Parameters
     api_key = 'YOUR_YOUTUBE_V3_API_KEY'
     params = {
         'q': prompt,
-        'part': 'snippet',
+        'part': 'id',  # Only the video id is used
         'type': 'video',
+        'maxResults': 1,
+        'fields': 'items(id/videoId)',  # Trim the response to the one field that is read
         'key': api_key,
     }
 
     # URL API YouTube
     url = 'https://www.googleapis.com/youtube/v3/search'
 
-    # Make the request to the YouTube API
-    response = requests.get(url, params=params)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        data = response.json()
-
-        # Check if there are results
-        if 'items' in data and len(data['items']) > 0:
-            # Get the link of the first result
-            first_video_id = data['items'][0]['id']['videoId']
-            video_link = f'https://www.youtube.com/watch?v={first_video_id}'
-            return video_link
-
-    return None
+    # Make the request to the YouTube API using the shared session
+    async with http_session.get(url, params=params) as response:
+        # Check if the request was successful
+        if response.status != 200:
+            return None
+        data = await response.json()
+
+    # Check if there are results
+    if 'items' in data and len(data['items']) > 0:
+        # Get the link of the first result
+        first_video_id = data['items'][0]['id']['videoId']
+        video_link = f'https://www.youtube.com/watch?v={first_video_id}'
+        remember_search(key, video_link, search_cache_ttl)
+        await asyncio.to_thread(save_search, key, video_link)
+    else:
+        # Remember searches without results for a shorter time
+        video_link = None
+        remember_search(key, video_link, search_cache_miss_ttl)
+    return video_link
+
+def remember_search(key, video_link, ttl):
+    # Remember the result, dropping the least recently used entry when full
+    search_cache[key] = (video_link, time.monotonic() + ttl)
+    if len(search_cache) > search_cache_size:
+        search_cache.popitem(last=False)
+
+# Saved searches survive restarts so popular songs do not use API quota again
+search_db = sqlite3.connect(search_db_path, check_same_thread=False)
+# WAL lets a commit append to the log instead of rewriting pages, and reads never wait on writes
+search_db.execute('PRAGMA journal_mode=WAL')
+search_db.execute('PRAGMA synchronous=NORMAL')
+search_db.execute('CREATE TABLE IF NOT EXISTS search_cache(q TEXT PRIMARY KEY, url TEXT, ts REAL)')
+search_db.execute('CREATE TABLE IF NOT EXISTS song_info(url TEXT PRIMARY KEY, id TEXT, title TEXT, acodec TEXT)')
+search_db.execute('CREATE INDEX IF NOT EXISTS song_info_id ON song_info(id)')
+search_db.execute('CREATE TABLE IF NOT EXISTS cache_songs(id TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL, hits INTEGER)')
+search_db_lock = threading.Lock()  # The connection is shared by worker threads
+# Expired searches are never read again, so drop them at startup to keep the file from growing forever
+search_db.execute('DELETE FROM search_cache WHERE ts < ?', (time.time() - search_cache_ttl,))
+search_db.commit()
+
+def load_search(key):
+    # Return (video link, age in seconds) of a saved search that has not expired
+    with search_db_lock:
+        row = search_db.execute(
+            'SELECT url, ts FROM search_cache WHERE q = ? AND ts > ?',
+            (key, time.time() - search_cache_ttl),
+        ).fetchone()
+    if row is None:
+        return None
+    return row[0], time.time() - row[1]
+
+def save_search(key, video_link):
+    with search_db_lock:
+        search_db.execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)', (key, video_link, time.time()))
+        search_db.commit()
 
 
 @bot.event
 async def on_ready():
-    logger.info(f'Connected as {bot.user.name}')
-    await update_presence.start()
+    global last_presence
+
+    logger.info('Connected as %s', bot.user.name)
+    # A new gateway session starts without a presence, so always send it once
+    last_presence = None
+    await set_presence(ufo)
+
+# Called whenever the presented song changes
+async def set_presence(name):
+    global ufo
+    global last_presence
 
-@tasks.loop(seconds=15)
-async def update_presence():
+    ufo = name[:128]  # Discord rejects longer activity names
+    # Only call the Discord API when the activity actually changed
+    if ufo == last_presence:
+        return
+    last_presence = ufo
     await bot.change_presence(
         activity=discord.Activity(
             type=discord.ActivityType.listening,  # Change the type to 'listening'
@@ -95,145 +352,589 @@ async def update_presence():
 async def on_command(ctx):
     author = ctx.author
     command = ctx.command
-    logger.info(f'Command "{command.name}" used by {author.name}#{author.discriminator}')
+    logger.info('Command "%s" used by %s#%s', command.name, author.name, author.discriminator)
+
+@bot.event
+async def on_guild_remove(guild):
+    # Drop the player state of a guild the bot was removed from, so states does not keep growing
+    state = states.pop(guild.id, None)
+    if state is not None:
+        await reset_player(state)
 
 @bot.command()
 async def play(ctx, *args):
-    global current_song  # Declared as a global variable
-    global channel
+    state = states[ctx.guild.id]
 
-    voice_channel = discord.utils.get(bot.voice_clients, guild=ctx.guild)
-    if voice_channel is not None and voice_channel.channel != ctx.author.voice.channel:
-        await ctx.send('I am already connected to a different voice channel.')
+    # The author has to be in a voice channel for the bot to join
+    author_voice = ctx.author.voice
+    if author_voice is None or author_voice.channel is None:
+        await ctx.send('Join a voice channel first.')
         return
 
-    if not (voice_channel and voice_channel.is_connected()):
-        channel = ctx.message.author.voice.channel
-        voice_channel = await channel.connect()
-        logger.info(f'Bot joined voice channel: {channel.name}')
+    # Keep each guild's queue bounded
+    if state.queue.qsize() >= max_queue_size:
+        await ctx.send(f'Queue full ({max_queue_size} songs). Try again later.')
+        return
+
+    # The bot only joins once the song is found, so a failed lookup never leaves it idle in the channel
+    voice_channel = ctx.voice_client
+    if voice_channel is not None and voice_channel.channel != author_voice.channel:
+        await ctx.send('I am already connected to a different voice channel.')
+        return
 
     # Join all the words provided in the input into a single search query
     search_query = ' '.join(args)
 
     try:
-        # Check if the input looks like a URL
-        if search_query.startswith('http'):
-            url = search_query
+        # Only resolve the metadata here so the song can be queued right away
+        if search_query.startswith(url_prefixes):
+            # The input looks like a URL
+            info_dict = await get_song_info(search_query)
+            # A bare playlist link has entries instead of formats, and would download the whole list into one slot
+            if 'entries' in info_dict:
+                await ctx.send('Playlists are not supported, send a link to a single video.')
+                return
         else:
-            # If not a URL, use searchinyt to search for the video
-            url = searchinyt(search_query)
-
-        ydl = yt_dlp.YoutubeDL(ydl_opts)
-        info_dict = ydl.extract_info(url, download=True)
-
-        # Create a random 5-letter text called atext
-        atext = "".join(random.choice(string.ascii_letters) for _ in range(5))
-
-        # renames the file to id+atext.mp3
-        os.rename(f'music/{info_dict["id"]}.mp3', f'music/{info_dict["id"]}{atext}.mp3')
-
+            # If not a URL, search for the video
+            info_dict = await find_song_info(search_query)
+            if info_dict is None:
+                await ctx.send(f'No results found for: {search_query}')
+                return
         song_name = info_dict['title']  # Get the song's name
-        file_path = f'music/{info_dict["id"]}{atext}.mp3'  # Get the file path
-
-        queue.append(file_path)
-        sname.append(song_name)
-
-        if not current_song:
-            play_next_song(voice_channel, ctx)  # Pass ctx as a parameter to the play_next_song function
-
-        logger.info(f'Added to queue: {song_name}')
-
-        # If there is a song playing, send a message that it has been added to the queue
-        if len(queue) >= 1:
-            await ctx.send(f'Added to queue: {song_name}')
+        # Opus audio is only remuxed by FFmpeg (every discord.py 2.x maps 'opus' to -c:a copy); anything else is encoded straight to Opus
+        codec = 'opus' if info_dict.get('acodec') == 'opus' else None
+
+        # The direct media URL lets the song start before its download has finished
+        stream_url = info_dict.get('url')
+        # Songs are only queued under the lock, which also keeps two commands from joining the channel at once
+        async with state.voice_lock:
+            # Other songs may have filled the queue while this one was looked up
+            if state.queue.qsize() >= max_queue_size:
+                await ctx.send(f'Queue full ({max_queue_size} songs). Try again later.')
+                return
+            # Join the author's channel, or rejoin if the player left for inactivity while the song was looked up
+            await join_voice(state, ctx, author_voice.channel)
+
+            # Only a song that is neither cached nor already downloading needs a download slot
+            video_id = info_dict['id']
+            slot_wait = download_semaphore.locked() and video_id not in cache_index and video_id not in pending_downloads
+            # Start downloading in the background; player_loop awaits it when the song is due
+            download_task = asyncio.create_task(fetch_song(info_dict))
+            download_tasks.add(download_task)
+            download_task.add_done_callback(download_tasks.discard)
+            state.queue.put_nowait(QueuedSong(download_task, song_name, codec, stream_url))
+
+            # Start the guild's player if it is not running yet
+            if state.player_task is None or state.player_task.done():
+                state.player_task = asyncio.create_task(player_loop(state, ctx.channel))  # The player only needs the channel to post in
+
+        # Let the user know when their download has to wait for a free slot
+        if slot_wait:
+            logger.info('Download queued, all %d slots busy: %s', max_downloads, song_name)
+            await ctx.send(f'All download slots are busy, {song_name} will download shortly.')
+        logger.info('Added to queue: %s', song_name)
+
+        announce_added(state, ctx.channel, song_name)
     except Exception as e:
-        logger.warning(f'Error playing the song: {str(e)}')
+        logger.warning('Error playing the song: %s', e)
+
+# Connect to the channel unless already connected; callers hold state.voice_lock
+async def join_voice(state, ctx, channel):
+    voice_channel = ctx.voice_client
+    if not (voice_channel and voice_channel.is_connected()):
+        voice_channel = await channel.connect()
+        logger.info('Bot joined voice channel: %s', channel.name)
+    state.voice_channel = voice_channel  # The player always uses the current connection
 
 @bot.command()
 async def skip(ctx):
-    if current_song:
-        voice_channel = discord.utils.get(bot.voice_clients, guild=ctx.guild)
-        voice_channel.stop()
+    state = states[ctx.guild.id]
+    if state.current_song and ctx.voice_client:
+        if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+            state.skip_requested = True
+            ctx.voice_client.stop()
+        elif state.download_wait is not None and not state.download_wait.done():
+            # The player is still waiting for the song's download
+            state.download_wait.set_result(None)
+        else:
+            # Between two songs there is nothing to skip yet
+            await ctx.send('Nothing is playing right now.')
+            return
         logger.info('Song skipped')
         await ctx.send('Song skipped')
 
 @bot.command()
 async def leave(ctx):
-    voice_channel = discord.utils.get(bot.voice_clients, guild=ctx.guild)
-    if voice_channel.is_connected():
-        await voice_channel.disconnect()
-        queue.clear()
-        sname.clear()
-        current_song = None
-        if inactive_timer:
-            inactive_timer.cancel()
-        logger.info('Disconnected due to command')
-        await ctx.send('Disconnected')
+    state = states[ctx.guild.id]
+    # Wait for a !play that is joining the channel, so it cannot reconnect right after
+    async with state.voice_lock:
+        voice_channel = ctx.voice_client
+        if voice_channel and voice_channel.is_connected():
+            # Stop the player before disconnecting: disconnect() stops the audio, which would wake it for the next song
+            await reset_player(state)
+            await voice_channel.disconnect()
+            state.voice_channel = None
+            logger.info('Disconnected due to command')
+            await ctx.send('Disconnected')
 
 @bot.command()
 async def ping(ctx):
-    voice_channel = discord.utils.get(bot.voice_clients, guild=ctx.guild)
+    voice_channel = ctx.voice_client
     if voice_channel and voice_channel.is_connected():
         latency = voice_channel.latency * 1000  # Latency in milliseconds
         await ctx.send(f'Current latency: {latency:.2f} ms')
         # If the latency is greater than 100, send a message that the latency is high
         if latency > 100:
             await ctx.send(f'Latency is very high')
-            logger.warning(f'Latency is high "{latency:.2f} ms"')
+            logger.warning('Latency is high "%.2f ms"', latency)
     else:
         await ctx.send('I am not connected to any voice channel.')
 
+# Delete every cached song that is not queued or playing; the cache is shared by all guilds
 @bot.command()
+@commands.is_owner()
+async def clearcache(ctx):
+    global cache_size
+
+    # The index already lists every cached file, so nothing has to be scanned or stat'ed
+    victims = [video_id for video_id, song in cache_index.items() if song.file_path not in file_refs]
+    file_paths = []
+    for video_id in victims:
+        song = cache_index.pop(video_id)
+        cache_size -= song.size
+        file_paths.append(song.file_path)
+    removed_songs.update(victims)
+    if file_paths:
+        await asyncio.to_thread(remove_files, file_paths)
+    await ctx.send(f'Cache cleared: {len(file_paths)} songs deleted, {len(cache_index)} in use kept.')
+
+@bot.command(aliases=['autor'])
 async def author(ctx):
-    await ctx.send('Author: <@!533093302031876096>')
-
-@bot.command()
-async def autor(ctx):
-    await ctx.send('Author: <@!533093302031876096>')
+    await ctx.send(author_message)
 
 def cleanup(file_path):
-    os.remove(file_path)
-    logger.info(f'File deleted: {file_path}')
-
-def play_next_song(voice_channel, ctx):
-    global current_song  # Declare as a global variable
-    global inactive_timer  # Declare as a global variable
-    global ufo # Declare as a global variable
-
-    if queue:
-        file_path = queue.pop(0) # Get the first file in the queue
-        ufo = sname[0]
-        song_name = sname.pop(0) # Get the first song name in the queue
-        current_song = file_path # Set the current song
-
-        voice_channel.play(discord.FFmpegPCMAudio(file_path), after=lambda e: song_finished(file_path, ctx))  # Pass ctx as a parameter
-        logger.info(f'Playing song: {file_path}: {song_name}') # Log the song's name
-        asyncio.run_coroutine_threadsafe(ctx.send(f'Playing song: {song_name}'), bot.loop) # Send a message that the song is playing
-        # Reset the inactivity timer
-        if inactive_timer:
-            inactive_timer.cancel() # Cancel the timer
-        inactive_timer = bot.loop.call_later(inactive_time, check_inactive, voice_channel, ctx) # Pass ctx as a parameter
+    # Release the file; it stays in the disk cache until evict_cache removes it
+    file_refs[file_path] -= 1
+    if file_refs[file_path] == 0:
+        del file_refs[file_path]
+
+# Build the cache index from the files already in music_dir
+async def initialize_cache_state():
+    global cache_size
+
+    # Scanning a large cache is slow, so it runs in a worker thread
+    saved = await asyncio.to_thread(load_cache_index)
+    files = await asyncio.to_thread(scan_cache_dir, saved)
+    # Insert the songs oldest first so cache_index starts in LRU order
+    files.sort(key=lambda file: file[3])
+    for video_id, file_path, size, last_used, hits in files:
+        cache_index[video_id] = CachedSong(file_path, size, last_used, hits)
+        cache_size += size
+    # Bring the saved index in line with what the scan found
+    changed_songs.update(
+        video_id for video_id, song in cache_index.items()
+        if saved.get(video_id) != (song.file_path, song.size, song.last_used, song.hits)
+    )
+    removed_songs.update(saved.keys() - cache_index.keys())
+    logger.info('Cache loaded: %d songs, %d bytes', len(cache_index), cache_size)
+
+# Save the cache index every cache_save_interval seconds, at most once per interval
+async def save_cache_index_loop():
+    while True:
+        await asyncio.sleep(cache_save_interval)
+        # A failed save is retried on the next interval instead of ending the loop
+        try:
+            await save_cache_index()
+        except Exception as e:
+            logger.error('Error saving the cache index: %s', e)
+
+async def save_cache_index():
+    # Only write the songs that changed since the last save
+    if not (changed_songs or removed_songs):
+        return
+    rows = []
+    for video_id in changed_songs:
+        song = cache_index.get(video_id)
+        if song is not None:
+            rows.append((video_id, song.file_path, song.size, song.last_used, song.hits))
+    removed = [(video_id,) for video_id in removed_songs if video_id not in cache_index]
+    changed = set(changed_songs)
+    gone = set(removed_songs)
+    changed_songs.clear()
+    removed_songs.clear()
+    try:
+        await asyncio.to_thread(write_cache_index, rows, removed)
+    except BaseException:
+        # Keep the batch for the next save; songs changed during the write are already back in the sets
+        changed_songs.update(changed)
+        removed_songs.update(gone)
+        raise
+
+def load_cache_index():
+    # Return video id -> (path, size, last used, hits) as saved by write_cache_index
+    with search_db_lock:
+        return {row[0]: row[1:] for row in search_db.execute('SELECT id, path, size, last_used, hits FROM cache_songs')}
+
+def write_cache_index(rows, removed):
+    # Apply a batch of changes in a single transaction
+    with search_db_lock, search_db:
+        search_db.executemany('INSERT OR REPLACE INTO cache_songs VALUES (?, ?, ?, ?, ?)', rows)
+        search_db.executemany('DELETE FROM cache_songs WHERE id = ?', removed)
+
+# Return (video id, path, size, last used, hits) of every cached file (runs in a worker thread)
+def scan_cache_dir(saved):
+    os.makedirs(music_dir, exist_ok=True)
+    with os.scandir(music_dir) as entries:
+        # Skip partial downloads; is_file() uses the directory entry type, so only stat() costs a syscall
+        songs = [
+            entry for entry in entries
+            if entry.is_file(follow_symlinks=False) and not entry.name.endswith(('.part', '.ytdl'))
+        ]
+
+    # When the directory holds exactly the saved files, trust their saved sizes and skip every stat()
+    if len(songs) == len(saved) and all(
+        saved.get(entry.name.partition('.')[0], ('',))[0] == entry.path for entry in songs
+    ):
+        return [(video_id, *row) for video_id, row in saved.items()]
+
+    def stat_entry(entry):
+        return entry.stat(follow_symlinks=False)
+
+    if len(songs) > 64:
+        # On network or FUSE mounts each stat() is a round trip, so overlap them
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix='scan') as executor:
+            stats = list(executor.map(stat_entry, songs))
     else:
-        current_song = None # Reset the current song
-        ufo = "idle"
-
-def song_finished(file_path, ctx):  # Add ctx as a parameter
-    cleanup(file_path)
-    logger.info(f'Song finished: {file_path}')
-
-    # Continue playing the next song in the queue
-    voice_channel = discord.utils.get(bot.voice_clients, guild=ctx.guild)
-    play_next_song(voice_channel, ctx)  # Pass ctx as a parameter
-
-def check_inactive(voice_channel, ctx):
-    global current_song  # Declare as a global variable
+        stats = [stat_entry(entry) for entry in songs]
+    files = []
+    for entry, stat in zip(songs, stats):
+        video_id = entry.name.partition('.')[0]
+        # Songs missing from the saved index start from the file's mtime
+        _, _, last_used, hits = saved.get(video_id, (None, None, stat.st_mtime, 1))
+        files.append((video_id, entry.path, stat.st_size, last_used, hits))
+    return files
+
+def add_cached_song(video_id, file_path, size):
+    global cache_size
+
+    old = cache_index.get(video_id)
+    if old is not None:
+        cache_size -= old.size
+    cache_index[video_id] = CachedSong(file_path, size, time.time())
+    cache_index.move_to_end(video_id)
+    cache_size += size
+    changed_songs.add(video_id)
+
+def touch_cached_song(video_id):
+    # Count the hit and move the song to the most recently used end
+    song = cache_index[video_id]
+    song.hits += 1
+    song.last_used = time.time()
+    cache_index.move_to_end(video_id)
+    changed_songs.add(video_id)
+
+# Evict songs until the cache fits, never touching songs still in use
+def evict_cache():
+    global cache_size
+
+    evicted = []
+    now = time.time()
+    while cache_size > max_cache_bytes:
+        # Like Redis, only compare a sample: the least recently used songs that are not playing or queued
+        candidates = list(itertools.islice(
+            (item for item in cache_index.items() if item[1].file_path not in file_refs),
+            eviction_samples,
+        ))
+        if not candidates:
+            break
+        # Old, large and rarely played songs go first, so a popular song is not evicted just for being old
+        video_id, song = max(
+            candidates,
+            key=lambda item: (now - item[1].last_used) * item[1].size / max(item[1].hits, 1),
+        )
+        del cache_index[video_id]
+        cache_size -= song.size
+        evicted.append(song.file_path)
+        removed_songs.add(video_id)
+
+    # Delete the files in a worker thread so the loop does not wait on the disk
+    if evicted:
+        bot.loop.run_in_executor(None, remove_files, evicted)  # The default executor, shared with asyncio.to_thread
+
+def remove_files(file_paths):
+    if len(file_paths) > 64:
+        # Clearing a large cache overlaps the unlink() calls
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix='unlink') as executor:
+            deleted = sum(executor.map(remove_file, file_paths))
+    else:
+        deleted = sum(map(remove_file, file_paths))
+    # One line per batch instead of one per file
+    if deleted:
+        logger.info('Deleted %d of %d cached files', deleted, len(file_paths))
 
-    # Disconnect from the voice channel due to inactivity
-    if not current_song:
-        voice_channel.stop()
-        asyncio.run_coroutine_threadsafe(voice_channel.disconnect(), bot.loop)
-        logger.info('Disconnected due to inactivity')
-        asyncio.run_coroutine_threadsafe(ctx.send('Disconnected due to inactivity'), bot.loop)
+def remove_file(file_path):
+    # Return whether the file was deleted
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        logger.warning('Cached file already gone: %s', file_path)
+    except OSError as e:
+        logger.error('Error deleting %s: %s', file_path, e)
+    else:
+        return True
+    return False
+
+# Resolve a song's metadata without downloading it (runs in a worker thread)
+def extract_song_info(url):
+    return get_ydl().extract_info(url, download=False)
+
+# Resolve a song's metadata, reusing a recent extraction of the same link
+async def get_song_info(url):
+    cached = metadata_cache.get(url)
+    if cached is not None:
+        info_dict, expires_at = cached
+        if time.monotonic() < expires_at:
+            metadata_cache.move_to_end(url)
+            return dict(info_dict)  # Each queued song gets its own copy to download from
+        del metadata_cache[url]
+
+    # A song that is still on disk only needs the id and title saved when it was first played
+    match = youtube_id_pattern.search(url)
+    video_id = match.group(1) if match else None
+    # Any form of a YouTube link finds the song by its id; uncached YouTube links skip the lookup entirely
+    saved = None
+    if video_id is None or video_id in cache_index:
+        saved = await asyncio.to_thread(load_song_info, url, video_id)
+    if saved is not None and saved[0] in cache_index:
+        video_id, title, acodec = saved
+        return {'id': video_id, 'title': title, 'acodec': acodec, 'webpage_url': url}
+
+    info_dict = await bot.loop.run_in_executor(extract_executor, extract_song_info, url)
+    remember_song_info(url, info_dict)
+    if 'entries' not in info_dict:
+        await asyncio.to_thread(save_song_info, url, info_dict)
+    return dict(info_dict)
+
+def remember_song_info(url, info_dict):
+    metadata_cache[url] = (info_dict, time.monotonic() + metadata_cache_ttl)
+    if len(metadata_cache) > metadata_cache_size:
+        metadata_cache.popitem(last=False)
+
+def load_song_info(url, video_id):
+    # Return (video id, title, codec) saved for a link or video id, or None
+    with search_db_lock:
+        return search_db.execute(
+            'SELECT id, title, acodec FROM song_info WHERE url = ? OR id = ? LIMIT 1',
+            (url, video_id),
+        ).fetchone()
+
+def save_song_info(url, info_dict):
+    with search_db_lock:
+        search_db.execute(
+            'INSERT OR REPLACE INTO song_info VALUES (?, ?, ?, ?)',
+            (url, info_dict['id'], info_dict['title'], info_dict.get('acodec')),
+        )
+        search_db.commit()
 
-# Start
-bot.run('YOUR_BOT_TOKEN')
+# Download a song whose metadata was already extracted (runs in a worker thread)
+def download_song(info_dict):
+    if 'formats' in info_dict or 'url' in info_dict:
+        info_dict = get_ydl().process_ie_result(info_dict, download=True)
+    else:
+        # Saved song info has no formats, so the song was evicted after it was queued; extract it again
+        info_dict = get_ydl().extract_info(info_dict['webpage_url'], download=True)
+    # yt-dlp reports where it saved the file; the output template is the fallback when it does not
+    downloads = info_dict.get('requested_downloads')
+    file_path = downloads[0]['filepath'] if downloads else get_ydl().prepare_filename(info_dict)
+    return file_path, os.path.getsize(file_path)
+
+# Get a song's file from the cache, or download it in a worker thread, limiting how many run at once
+async def fetch_song(info_dict):
+    video_id = info_dict['id']
+    song = cache_index.get(video_id)
+    if song is not None:
+        touch_cached_song(video_id)
+        file_path = song.file_path
+    else:
+        file_path = await download_song_once(video_id, info_dict)
+    file_refs[file_path] = file_refs.get(file_path, 0) + 1
+
+    # Keep the disk cache within its size limit
+    evict_cache()
+    return file_path
+
+async def download_song_once(video_id, info_dict):
+    # A song queued again while it downloads shares the running download instead of writing the same file twice
+    pending = pending_downloads.get(video_id)
+    if pending is None:
+        pending = asyncio.create_task(download_and_cache(video_id, info_dict))
+        pending_downloads[video_id] = pending
+        pending.add_done_callback(lambda task: pending_downloads.pop(video_id, None))
+        return await asyncio.shield(pending)
+
+    file_path = await asyncio.shield(pending)
+    if video_id in cache_index:
+        touch_cached_song(video_id)
+    return file_path
+
+async def download_and_cache(video_id, info_dict):
+    async with download_semaphore:
+        file_path, size = await bot.loop.run_in_executor(download_executor, download_song, info_dict)
+    add_cached_song(video_id, file_path, size)
+    return file_path
+
+# Play a guild's queued songs one after another; runs as one task per guild on the bot's loop
+async def player_loop(state, channel):
+    while True:
+        # Wait for the next song in the queue, disconnecting if none arrives in time
+        try:
+            song = await asyncio.wait_for(state.queue.get(), timeout=inactive_time)
+        except asyncio.TimeoutError:
+            # Hold the lock !play queues songs under, so no song can arrive while the bot leaves
+            async with state.voice_lock:
+                if not state.queue.empty():
+                    continue  # A song was queued while this waited for the lock
+                await state.voice_channel.disconnect()
+                state.voice_channel = None
+                state.player_task = None  # The next !play starts a new player instead of waiting for this one
+            logger.info('Disconnected due to inactivity')
+            await channel.send('Disconnected due to inactivity')
+            return
+        state.song_name = song.song_name
+        state.current_song = song.download_task # Mark a song as current before waiting for the download
+
+        # The song's file is released however it ends, even if the player is cancelled
+        try:
+            if not song.download_task.done() and song.stream_url:
+                # Stream from YouTube while the download finishes in the background for the cache
+                file_path = song.stream_url
+            else:
+                file_path = await wait_for_download(state, song)
+            retried = False
+            while file_path is not None:
+                streaming = file_path == song.stream_url
+                state.current_song = file_path # Set the current song
+                try:
+                    before_options = ffmpeg_stream_before_options if streaming else ffmpeg_before_options
+                    source = discord.FFmpegOpusAudio(file_path, codec=song.codec, before_options=before_options, options=ffmpeg_options)
+                    # Forget any stop() that happened while nothing was playing, so only this song's end sets the event
+                    state.playback_done.clear()
+                    state.skip_requested = False
+                    # The after-callback runs on FFmpeg's thread, so only hand its result back to the loop
+                    state.voice_channel.play(source, after=lambda e: bot.loop.call_soon_threadsafe(song_ended, state, e))
+                except Exception as e:
+                    logger.warning('Error starting the song: %s', e)
+                    break
+                started = time.monotonic()
+                logger.info('Playing song: %s (%s)', song.song_name, 'stream' if streaming else file_path) # The stream URL is signed, so it is not logged
+                await set_presence(song.song_name) # The presence shows the most recently started song
+                if not retried:
+                    await channel.send(f'Playing song: {song.song_name}') # Send a message that the song is playing
+                # Wait until the song ends or is skipped
+                await state.playback_done.wait()
+                state.playback_done.clear()
+
+                # A failed stream (expired URL, 403, dropped connection) ends right away; play the download instead
+                if not streaming or state.skip_requested or (state.play_error is None and time.monotonic() - started >= stream_min_play_time):
+                    logger.info('Song finished: %s', song.song_name)
+                    break
+                logger.warning('Stream of %s ended early, playing the download instead: %s', song.song_name, state.play_error)
+                retried = True
+                file_path = await wait_for_download(state, song)
+        finally:
+            state.playback_done.clear()
+            release_song(song.download_task)
+
+        if state.queue.empty():
+            await set_idle(state)
+
+# Wait for a song's download; returns its file path, or None when the song was skipped or failed to download
+async def wait_for_download(state, song):
+    if not song.download_task.done():
+        # !skip resolves download_wait while nothing is playing yet, dropping the song before it starts
+        skipped = state.download_wait = bot.loop.create_future()
+        try:
+            await asyncio.wait({song.download_task, skipped}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            state.download_wait = None
+        if skipped.done():
+            logger.info('Song skipped before its download finished: %s', song.song_name)
+            return None # The download still finishes into the cache
+    try:
+        return await song.download_task # Usually already finished while the previous song played
+    except Exception:
+        return None # release_song logs the error
+
+def song_ended(state, error):
+    # Runs on the loop once FFmpeg's player thread reports the end of the song
+    state.play_error = error
+    state.playback_done.set()
+
+async def set_idle(state):
+    state.current_song = None # Reset the current song
+    state.song_name = None
+    # Fall back to a song still playing in another guild, if any
+    await set_presence(next((other.song_name for other in states.values() if other.song_name), "idle"))
+
+def announce_added(state, channel, song_name):
+    state.added_songs.append(song_name)
+    if state.announce_task is None:
+        state.announce_task = asyncio.create_task(send_added_songs(state, channel))
+
+async def send_added_songs(state, channel):
+    # Songs added in a burst share one message, keeping the channel clear of the rate limit
+    await asyncio.sleep(added_message_delay)
+    song_names = state.added_songs
+    state.added_songs = []
+    state.announce_task = None
+    if len(song_names) == 1:
+        message = f'Added to queue: {song_names[0]}'
+    else:
+        message = f'Added {len(song_names)} songs to queue:\n' + '\n'.join(song_names)
+    # Nobody awaits this task, so a failed send is only logged
+    try:
+        await channel.send(message[:2000])  # Discord's message length limit
+    except discord.HTTPException as e:
+        logger.warning('Error announcing added songs: %s', e)
+
+def release_song(download_task):
+    # Release the song's cached file, waiting for its download to finish if needed
+    if not download_task.done():
+        download_task.add_done_callback(release_song)
+    elif download_task.cancelled():
+        return
+    elif download_task.exception() is not None:
+        logger.warning('Error downloading the song: %s', download_task.exception())
+    else:
+        cleanup(download_task.result())
+
+def clear_queue(state):
+    # Drop every queued song, releasing files that were already downloaded
+    while not state.queue.empty():
+        song = state.queue.get_nowait()
+        song.download_task.cancel()
+        release_song(song.download_task)
+
+def stop_player(state):
+    if state.player_task:
+        state.player_task.cancel()
+        state.player_task = None
+
+# Stop a guild's player and forget its queue and current song
+async def reset_player(state):
+    stop_player(state)
+    clear_queue(state)
+    # The cleared songs must not be announced afterwards
+    if state.announce_task:
+        state.announce_task.cancel()
+        state.announce_task = None
+    state.added_songs = []
+    state.playback_done.clear()
+    await set_idle(state)
+
+# bot.run creates its loop through asyncio.run, so the policy must be set first
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# Start (log_handler=None keeps discord.py from adding its own synchronous handler)
+bot.run('YOUR_BOT_TOKEN', log_handler=None)